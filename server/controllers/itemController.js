@@ -1,6 +1,7 @@
 const Item = require('../models/Item');
 const Node = require('../models/Node');
 const Track = require('../models/Track');
+const StoryCluster = require('../models/StoryCluster');
 const modelApi = require('../services/modelApi');
 const { uploadFile } = require('../services/r2Storage');
 
@@ -154,20 +155,30 @@ const concludeTrackInternal = async (track) => {
         return track;
     }
 
-    // Find other users' stories from this week for community reflection
-    const otherTracks = await Track.find({
-        user_id: { $ne: track.user_id },
-        week_id: track.week_id,
-        story: { $ne: null, $ne: '' }
-    }).limit(6);
+    // Prefer the precomputed theme summary of this track's weekly cluster;
+    // fall back to a few raw stories from other users this week.
+    let clusterSummary = null;
+    if (track.story_cluster_id) {
+        const cluster = await StoryCluster.findById(track.story_cluster_id).select('summary');
+        clusterSummary = cluster ? cluster.summary : null;
+    }
 
-    const similarStories = otherTracks
-        .map(t => t.story)
-        .filter(s => s && s.length > 0)
-        .slice(0, 3);
+    let similarStories = [];
+    if (!clusterSummary) {
+        const otherTracks = await Track.find({
+            user_id: { $ne: track.user_id },
+            week_id: track.week_id,
+            story: { $ne: null, $ne: '' }
+        }).select('story').limit(6).lean();
+
+        similarStories = otherTracks
+            .map(t => t.story)
+            .filter(s => s && s.length > 0)
+            .slice(0, 3);
+    }
 
     try {
-        const result = await modelApi.generateConclusion(story, similarStories);
+        const result = await modelApi.generateConclusion(story, similarStories, clusterSummary);
         track.story = `${story}\n\n${result.conclusion}`;
         track.community_reflection = result.community_reflection || '';
     } catch (err) {
@@ -247,7 +258,8 @@ const createItem = async (req, res) => {
                         files[0].buffer,
                         files[0].originalname,
                         storySoFar,
-                        files[0].mimetype
+                        files[0].mimetype,
+                        userId
                     );
                     finalDescription = mlResult.description;
                     storySegment = mlResult.story_segment;
@@ -37,5 +37,7 @@ const itemSchema = new mongoose.Schema({
     }
 });
 
+// A user's items in posting order (also used by the ML pipeline scripts)
+itemSchema.index({ user_id: 1, created_at: 1 });
 
 module.exports = mongoose.model('Item', itemSchema);
\ No newline at end of file
@@ -0,0 +1,32 @@
+const mongoose = require('mongoose');
+
+// Written by services/ml/storyClusters.py — one document per cluster of
+// similar track stories in a week, with a theme summary generated once.
+const storyClusterSchema = new mongoose.Schema({
+    week_id: {
+        type: String, // e.g., "2026-W06"
+        required: true,
+        index: true
+    },
+    summary: {
+        type: String,
+        required: true
+    },
+    track_ids: [{
+        type: mongoose.Schema.Types.ObjectId,
+        ref: 'Track'
+    }],
+    stories_digest: {
+        type: String // sha256 of the members' stories; the summary is regenerated when it changes
+    },
+    size: {
+        type: Number,
+        default: 0
+    },
+    created_at: {
+        type: Date,
+        default: Date.now
+    }
+});
+
+module.exports = mongoose.model('StoryCluster', storyClusterSchema, 'story_clusters');
@@ -26,10 +26,20 @@ const trackSchema = new mongoose.Schema({
         type: String, // e.g., "2026-W06"
         required: true
     },
+    // Set by the weekly story clustering job (services/ml/storyClusters.py)
+    story_cluster_id: {
+        type: mongoose.Schema.Types.ObjectId,
+        ref: 'StoryCluster',
+        default: null
+    },
     created_at: {
         type: Date,
         default: Date.now
     }
 });
 
+// Current-track lookup per user, and per-week queries (story clustering)
+trackSchema.index({ user_id: 1, week_id: 1 });
+trackSchema.index({ week_id: 1 });
+
 module.exports = mongoose.model('Track', trackSchema);
@@ -0,0 +1,108 @@
+"""
+Config — environment, Gemini client and MongoDB handle shared by every module.
+
+Importing this module only loads .env, once. google.genai and pymongo are
+imported the first time get_client() / get_db() is called, so importing
+server.py or a script is cheap and every module reuses the same client.
+warm_up() does that work ahead of time, before the server starts accepting
+requests.
+"""
+
+from pathlib import Path
+from dotenv import load_dotenv
+import os
+import threading
+
+# Load .env from server directory
+load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env')
+
+GEMINI_MODEL = "gemini-2.5-flash"
+EMBEDDING_MODEL = "gemini-embedding-001"
+DB_NAME = "cutting-room"
+
+# Indexes the pipeline scripts' queries rely on, as (collection, keys).
+# The Node models declare the same ones for the API's own queries.
+PIPELINE_INDEXES = [
+    ("items", [("user_id", 1), ("created_at", 1)]),   # a user's items in posting order
+    ("users", [("username", 1)]),                      # seed user lookups (anchored regex)
+    ("tracks", [("week_id", 1)]),                      # per-week story clustering
+    ("story_clusters", [("week_id", 1)]),
+]
+
+_lock = threading.Lock()
+_client = None
+_db = None
+_prompt_cache = None
+
+
+def setting(name, default):
+    """Read an environment setting, cast to the type of its default."""
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return type(default)(value) if default is not None else value
+
+
+def get_client():
+    """The shared google.genai Client, created on first use."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import google.genai as genai
+                _client = genai.Client(api_key=os.environ.get("GOOGLE_GEMINI_API"))
+    return _client
+
+
+def get_db():
+    """The shared MongoDB database handle, connected on first use."""
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                from pymongo import MongoClient
+                _db = MongoClient(os.environ.get("MONGODB_URI"))[DB_NAME]
+    return _db
+
+
+def ensure_indexes():
+    """
+    Create any PIPELINE_INDEXES that are missing. An existing index on the
+    same keys counts (e.g. Mongoose's unique username index), so options
+    never conflict.
+    """
+    db = get_db()
+    for name, keys in PIPELINE_INDEXES:
+        existing = [list(info["key"]) for info in db[name].index_information().values()]
+        if keys not in existing:
+            db[name].create_index(keys)
+
+
+def get_prompt_cache():
+    """The shared PromptCache, bound to the shared client."""
+    global _prompt_cache
+    if _prompt_cache is None:
+        from promptCache import create_prompt_cache
+        client = get_client()
+        with _lock:
+            if _prompt_cache is None:
+                _prompt_cache = create_prompt_cache(client)
+    return _prompt_cache
+
+
+def warm_up():
+    """
+    Pay the cold-start costs up front: import google.genai, build the client
+    and open a connection to the API with a cheap metadata request. Failures
+    are logged, not raised — the service can still start and retry later.
+    """
+    import google.genai.types  # noqa: F401  (the slowest import; load it now)
+
+    if not os.environ.get("GOOGLE_GEMINI_API"):
+        print("Warm-up: GOOGLE_GEMINI_API not set, skipping Gemini client")
+        return
+    try:
+        get_prompt_cache()
+        get_client().models.get(model=GEMINI_MODEL)
+    except Exception as e:
+        print(f"Warm-up: could not reach Gemini ({e})")
@@ -12,28 +12,20 @@ Usage:
     python demoPipeline.py
 """
 
-import google.genai as genai
-from pymongo import MongoClient
 from bson import ObjectId
 from pathlib import Path
-from dotenv import load_dotenv
 from datetime import datetime
-import os
 import time
 
+from config import ensure_indexes, get_db
+
 # ─── Config ───────────────────────────────────────────────────────
-load_dotenv(Path(__file__).resolve().parent.parent.parent  / '.env')
 
 BATCH_SIZE = 6                # items per LLM batch before cooldown
 BATCH_DELAY_SECONDS = 65      # RPM cooldown between batches
 INTRA_DELAY_SECONDS = 10      # 10s delay between individual LLM calls
 
-# MongoDB
-mongo_client = MongoClient(os.environ.get("MONGODB_URI"))
-db = mongo_client["cutting-room"]
-
-# Gemini (used by imported modules, but also here for conclusion)
-client = genai.Client(api_key=os.environ.get("GOOGLE_GEMINI_API"))
+# MongoDB and the Gemini client come from config (connected on first use)
 
 # Import the ML functions
 from storyGeneration import generate_recap_sentence
@@ -50,14 +42,22 @@ def get_week_id():
 
 def get_seed_users():
     """Get all seed users from the database."""
-    users = list(db.users.find({"username": {"$regex": "^seed_user_"}}))
+    # Anchored prefix regex, so it can use the username index
+    users = list(get_db().users.find({"username": {"$regex": "^seed_user_"}}, {"username": 1}))
     print(f"Found {len(users)} seed users")
     return users
 
 
 def get_user_items(user_id):
-    """Get all items for a user, sorted by creation time."""
-    items = list(db.items.find({"user_id": user_id}).sort("created_at", 1))
+    """
+    Get all items for a user, sorted by creation time.
+    Served by the items (user_id, created_at) index; the embedding isn't
+    needed here, so only the fields the pipeline reads are fetched.
+    """
+    items = list(get_db().items.find(
+        {"user_id": user_id},
+        {"description": 1, "content_url": 1}
+    ).sort("created_at", 1))
     return items
 
 
@@ -89,6 +89,7 @@ def process_user(user, all_stories, call_count):
 
     Returns (track_doc, call_count).
     """
+    db = get_db()
     user_id = user["_id"]
     username = user["username"]
     items = get_user_items(user_id)
@@ -240,11 +241,15 @@ def process_user(user, all_stories, call_count):
 # ─── Main ─────────────────────────────────────────────────────────
 
 def main():
+    db = get_db()
+
     print("=" * 60)
     print("  The Cutting Room — Demo Pipeline")
     print("  Node creation → Story chaining → Track conclusion")
     print("=" * 60)
 
+    ensure_indexes()
+
     # Clean previous demo data (nodes + tracks only, keep items)
     deleted_nodes = db.nodes.delete_many({})
     deleted_tracks = db.tracks.delete_many({})
@@ -255,7 +260,7 @@ def main():
         print("No seed users found. Run seed.py first.")
         return
 
-    total_items = db.items.count_documents({})
+    total_items = db.items.estimated_document_count()
     print(f"Total items in DB: {total_items}")
 
     all_stories = []
@@ -279,9 +284,21 @@ def main():
     print(f"  GENERATED STORIES")
     print(f"{'=' * 60}")
 
-    for track in db.tracks.find({}):
-        user = db.users.find_one({"_id": track["user_id"]})
-        username = user["username"] if user else "unknown"
+    tracks = list(db.tracks.find(
+        {},
+        {"user_id": 1, "week_id": 1, "story": 1, "community_reflection": 1, "concluded": 1}
+    ))
+    # One $in lookup for every track owner instead of one find_one per track
+    usernames = {
+        user["_id"]: user["username"]
+        for user in db.users.find(
+            {"_id": {"$in": list({t["user_id"] for t in tracks})}},
+            {"username": 1}
+        )
+    }
+
+    for track in tracks:
+        username = usernames.get(track["user_id"], "unknown")
         print(f"\n┌─ {username} (week {track['week_id']}) ─────────────")
         print(f"│")
         for line in (track.get("story") or "").split("\n"):
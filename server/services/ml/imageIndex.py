@@ -0,0 +1,138 @@
+"""
+Perceptual-hash index over images that already have a vision description.
+
+Users post bursts of near-identical photos and the seed folders contain
+duplicates. Before paying for a vision call, look the upload's dHash up here;
+anything within MAX_DISTANCE bits can reuse the stored description.
+
+Entries carry the uploading user as an owner, and nothing is stored or
+looked up without one. Only the owner's own images match approximately;
+another user's entry is reused only for byte-identical uploads (same
+sha256), since visibly different photos can share a dHash. One person never
+gets a story written from a stranger's different photo.
+Flat or dark images have almost no set (or unset) bits and look alike to
+dHash, so low-information hashes are neither stored nor looked up.
+
+Given a SharedStore, entries are also written to SQLite and each process
+pulls rows added by other workers before searching.
+"""
+
+from collections import OrderedDict
+import json
+import threading
+
+from config import setting
+
+MAX_DISTANCE = setting("ML_DEDUPE_MAX_DISTANCE", 6)   # out of 64 bits; -1 disables
+MAX_ENTRIES = setting("ML_DEDUPE_INDEX_SIZE", 10000)
+MIN_SET_BITS = 8                # hashes with fewer set (or unset) bits are too plain to trust
+
+
+def hash_to_hex(hash_value):
+    """64-bit hash as a fixed-width hex string (MongoDB ints are signed 64-bit)."""
+    return f"{hash_value:016x}"
+
+
+def hex_to_hash(hex_value):
+    return int(hex_value, 16)
+
+
+def is_informative(hash_value):
+    """False for hashes of near-uniform images (sky, darkness, blank pages)."""
+    return hash_value is not None and MIN_SET_BITS <= hash_value.bit_count() <= 64 - MIN_SET_BITS
+
+
+def _to_signed(hash_value):
+    """SQLite INTEGER is signed 64-bit."""
+    return hash_value - (1 << 64) if hash_value >= (1 << 63) else hash_value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class ImageHashIndex:
+    """
+    Thread-safe, size-bounded map of dHash -> stored result.
+
+    Lookups are a linear Hamming-distance scan; at 64-bit ints and a few
+    thousand entries that is well under a millisecond. The least recently
+    matched entries are evicted first.
+    """
+
+    def __init__(self, max_distance=MAX_DISTANCE, max_entries=MAX_ENTRIES, store=None):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_id = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, hash_value, data, owner=None, sha256=None):
+        """
+        Store data (e.g. {"description": ...}) under an image hash for owner.
+        sha256 of the original bytes lets other owners reuse exact copies.
+        """
+        if owner is None or not is_informative(hash_value) or self.max_distance < 0:
+            return
+        data = dict(data, owner=owner, sha256=sha256)
+        with self._lock:
+            self._remember(hash_value, data)
+
+        if self.store is not None:
+            with self.store.transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO image_hashes (hash, data) VALUES (?, ?)",
+                    (_to_signed(hash_value), json.dumps(data))
+                )
+                # Keep roughly the newest max_entries rows host-wide
+                conn.execute(
+                    "DELETE FROM image_hashes WHERE id <= (SELECT MAX(id) FROM image_hashes) - ?",
+                    (self.max_entries,)
+                )
+
+    def find(self, hash_value, owner=None, sha256=None):
+        """
+        Return (data, distance) for the closest of owner's stored images
+        within max_distance bits (or another owner's with the same sha256),
+        or (None, None) if there is no near-duplicate.
+        """
+        if owner is None or not is_informative(hash_value) or self.max_distance < 0:
+            return None, None
+        with self._lock:
+            if self.store is not None:
+                self._pull()
+
+            best_hash, best_distance = None, self.max_distance + 1
+            for stored_hash, data in self._entries.items():
+                distance = (stored_hash ^ hash_value).bit_count()
+                if data.get("owner") != owner and (sha256 is None or data.get("sha256") != sha256):
+                    continue
+                if distance < best_distance:
+                    best_hash, best_distance = stored_hash, distance
+                    if distance == 0:
+                        break
+
+            if best_hash is None:
+                return None, None
+            self._entries.move_to_end(best_hash)
+            return self._entries[best_hash], best_distance
+
+    def _remember(self, hash_value, data):
+        self._entries[hash_value] = data
+        self._entries.move_to_end(hash_value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _pull(self):
+        """Load rows other workers added since the last pull (caller holds the lock)."""
+        rows = self.store.connect().execute(
+            "SELECT id, hash, data FROM image_hashes WHERE id > ? ORDER BY id",
+            (self._last_id,)
+        ).fetchall()
+        for row_id, hash_value, data in rows:
+            self._remember(_to_unsigned(hash_value), json.loads(data))
+            self._last_id = row_id
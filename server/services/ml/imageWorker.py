@@ -0,0 +1,172 @@
+"""
+Image worker — CPU-bound Pillow work kept off the FastAPI event loop.
+
+Decoding, resizing and re-encoding uploads holds the GIL, so large images
+are shipped to a warm process pool sized to the machine's cores. Small
+images are cheap enough that the pickling round-trip costs more than the
+work itself; those run in a thread instead.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
+import asyncio
+import io
+import os
+import threading
+
+from config import setting
+
+MAX_DIMENSION = setting("ML_IMAGE_MAX_DIMENSION", 1536)   # longest edge sent to Gemini
+INLINE_MAX_BYTES = setting("ML_IMAGE_INLINE_MAX_BYTES", 256 * 1024)
+POOL_SIZE = setting("ML_IMAGE_WORKERS", os.cpu_count() or 1)
+MAX_PIXELS = setting("ML_IMAGE_MAX_PIXELS", 40_000_000)   # ~160MB decoded RGBA per worker
+JPEG_QUALITY = 85
+
+# Formats Gemini accepts as-is; anything else is re-encoded to JPEG.
+PASSTHROUGH_MIME_TYPES = {"image/jpeg", "image/png", "image/webp"}
+
+# Pillow only raises past 2x this; preprocess_image enforces MAX_PIXELS itself
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def dhash(img, hash_size=8):
+    """
+    Difference hash of a PIL image as a 64-bit int.
+
+    Shrinks to (hash_size+1) x hash_size grayscale and records whether each
+    pixel is brighter than its right neighbour. Near-identical photos (burst
+    shots, re-encodes, small crops) land within a few bits of each other.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _downscaled(img):
+    """
+    Oriented copy of img no larger than MAX_DIMENSION. JPEGs are decoded
+    straight at a reduced DCT scale (draft), so a 12MP photo is never
+    decoded at full size.
+    """
+    img.draft(None, (MAX_DIMENSION, MAX_DIMENSION))
+    oriented = ImageOps.exif_transpose(img)
+    oriented.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.Resampling.LANCZOS)
+    return oriented
+
+
+def image_hash(image_bytes):
+    """dHash of raw image bytes, taken the same way preprocess_image does."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return dhash(_downscaled(img))
+
+
+def preprocess_image(image_bytes, mime_type):
+    """
+    Decode, orient and downscale an image for the vision model, and hash it.
+
+    Runs inside a pool worker, so it must stay a plain module-level function.
+    Returns (image_bytes, mime_type, dhash). image_bytes is None when the
+    image is already small enough and in a supported format — that way the
+    original bytes never have to be pickled back across the process boundary.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Checked before decoding: the header alone gives the size
+        if img.width * img.height > MAX_PIXELS:
+            raise ValueError(f"{img.width}x{img.height} image exceeds {MAX_PIXELS} pixels")
+
+        needs_resize = max(img.size) > MAX_DIMENSION
+        rotated = img.getexif().get(0x0112, 1) != 1   # EXIF orientation tag
+
+        if not needs_resize and not rotated and mime_type in PASSTHROUGH_MIME_TYPES:
+            return None, mime_type, dhash(img)
+
+        oriented = _downscaled(img)
+        hash_value = dhash(oriented)
+        if oriented.mode not in ("RGB", "L"):
+            oriented = oriented.convert("RGB")
+
+        out = io.BytesIO()
+        oriented.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return out.getvalue(), "image/jpeg", hash_value
+
+
+def _noop():
+    return None
+
+
+def start_pool():
+    """Create the process pool and spawn every worker up front."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE)
+            # Executors fork lazily; one task per slot forces all workers to exist
+            # before the first real upload arrives.
+            for future in [_pool.submit(_noop) for _ in range(POOL_SIZE)]:
+                future.result()
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the process pool (called on server shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def _restart_pool(broken):
+    """
+    Replace a pool whose worker died (e.g. OOM-killed). A broken executor
+    fails every later submit, so without this all large uploads would skip
+    preprocessing until the service restarts.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:
+            return     # another request already replaced it
+        _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+    start_pool()
+
+
+async def prepare_image(image_bytes, mime_type):
+    """
+    Preprocess an uploaded image without blocking the event loop.
+
+    Returns (image_bytes, mime_type, dhash). Small images run in a thread;
+    larger ones go to the process pool. If Pillow can't decode the upload,
+    the original bytes are returned with no hash and Gemini gets to decide
+    what to make of them.
+    """
+    loop = asyncio.get_running_loop()
+    pool = None
+    try:
+        if len(image_bytes) <= INLINE_MAX_BYTES:
+            result = await asyncio.to_thread(preprocess_image, image_bytes, mime_type)
+        else:
+            pool = _pool or await asyncio.to_thread(start_pool)
+            result = await loop.run_in_executor(pool, preprocess_image, image_bytes, mime_type)
+    except BrokenProcessPool as e:
+        # Don't retry this image — it may be what killed the worker
+        print(f"Image pool broke ({mime_type}, {len(image_bytes)} bytes), restarting it: {e}")
+        await asyncio.to_thread(_restart_pool, pool)
+        return image_bytes, mime_type, None
+    except Exception as e:
+        print(f"Image preprocessing failed ({mime_type}, {len(image_bytes)} bytes): {e}")
+        return image_bytes, mime_type, None
+
+    processed_bytes, processed_mime, hash_value = result
+    if processed_bytes is None:
+        return image_bytes, mime_type, hash_value
+    return processed_bytes, processed_mime, hash_value
@@ -0,0 +1,441 @@
+"""
+Prompt cache — reuse Gemini cached-content handles for stable prompt prefixes.
+
+Every generation call starts with the same static instructions, and a
+track's story_so_far only ever grows by appending. Both are cached upstream
+once and referenced by handle, so each call only sends the new part.
+
+    prompt_cache = create_prompt_cache(client)
+    response = prompt_cache.generate(
+        client, "story", STORY_INSTRUCTIONS,
+        prefix=story_header,
+        contents=[moment],
+        response_mime_type="application/json",
+    )
+
+Gemini refuses to cache prompts below a minimum size (~1024 tokens on
+2.5 Flash), so prefixes shorter than MIN_CHARS are sent inline with the
+instructions as a system instruction. Keeping the static part first still
+lets the implicit prefix cache do its work on those calls.
+
+ML_PROMPT_CACHE selects the backend: "gemini" (default), "local" (an
+in-memory stand-in for tests, no network) or "off". In multi-worker mode
+the handle registry lives in the shared SQLite store.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
+import threading
+import time
+
+from config import GEMINI_MODEL, setting
+from rateLimiter import gemini_limiter
+from sharedState import get_store
+
+BACKEND = setting("ML_PROMPT_CACHE", "gemini")
+TTL_SECONDS = setting("ML_PROMPT_CACHE_TTL", 3600)
+REFRESH_MARGIN_SECONDS = 300     # extend the TTL once less than this remains
+MIN_CHARS = setting("ML_PROMPT_CACHE_MIN_CHARS", 4096)   # ~1024 tokens
+MAX_ENTRIES = 256
+TOUCH_INTERVAL_SECONDS = 60      # how stale a shared last_used may get (LRU eviction order only)
+FAILURE_BACKOFF_SECONDS = 600    # don't retry a namespace whose cache creation just errored
+FINGERPRINT_CHARS = 512          # a growing prefix keeps its head, so this identifies e.g. one track
+MAX_SIGHTINGS = 4096
+
+
+class GeminiCacheBackend:
+    """Cached-content handles stored upstream via client.caches."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model, system_instruction, contents, ttl_seconds, display_name):
+        import google.genai.types as types
+
+        cache = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                display_name=display_name,
+                system_instruction=system_instruction,
+                contents=contents or None,
+                ttl=f"{ttl_seconds}s"
+            )
+        )
+        return cache.name
+
+    def refresh(self, name, ttl_seconds):
+        import google.genai.types as types
+
+        self.client.caches.update(
+            name=name,
+            config=types.UpdateCachedContentConfig(ttl=f"{ttl_seconds}s")
+        )
+
+    def delete(self, name):
+        self.client.caches.delete(name=name)
+
+
+class LocalCacheBackend:
+    """
+    In-memory stand-in for tests. Hands out fake handle names and keeps what
+    would have been cached in `entries`, so a stubbed client can resolve them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._ids = itertools.count(1)
+
+    def create(self, model, system_instruction, contents, ttl_seconds, display_name):
+        name = f"cachedContents/local-{next(self._ids)}"
+        self.entries[name] = {
+            "model": model,
+            "system_instruction": system_instruction,
+            "contents": contents,
+            "ttl_seconds": ttl_seconds,
+            "display_name": display_name
+        }
+        return name
+
+    def refresh(self, name, ttl_seconds):
+        if name not in self.entries:
+            raise KeyError(name)
+        self.entries[name]["ttl_seconds"] = ttl_seconds
+
+    def delete(self, name):
+        self.entries.pop(name, None)
+
+
+class MemoryRegistry:
+    """Handle bookkeeping for a single process."""
+
+    def __init__(self):
+        self._entries = OrderedDict()    # name -> {name, scope, prefix, expires_at}
+
+    def longest_match(self, scope, prefix, now):
+        best = None
+        for entry in self._entries.values():
+            if entry["scope"] == scope and entry["expires_at"] > now and prefix.startswith(entry["prefix"]):
+                if best is None or len(entry["prefix"]) > len(best["prefix"]):
+                    best = entry
+        return dict(best) if best else None
+
+    def put(self, entry):
+        self._entries[entry["name"]] = dict(entry)
+
+    def touch(self, name, expires_at=None):
+        if name in self._entries:
+            if expires_at is not None:
+                self._entries[name]["expires_at"] = expires_at
+            self._entries.move_to_end(name)
+
+    def remove(self, name):
+        self._entries.pop(name, None)
+
+    def drop_expired(self, now):
+        for name in [n for n, e in self._entries.items() if e["expires_at"] <= now]:
+            del self._entries[name]
+
+    def least_recent(self, keep):
+        """Names beyond the `keep` most recently used."""
+        return list(self._entries)[:max(0, len(self._entries) - keep)]
+
+    def names(self):
+        return list(self._entries)
+
+
+class SqliteRegistry:
+    """Handle bookkeeping in the shared store, visible to every worker."""
+
+    def __init__(self, store):
+        self.store = store
+        self._touched = {}               # name -> when this process last wrote last_used
+
+    def longest_match(self, scope, prefix, now):
+        row = self.store.connect().execute(
+            """SELECT name, prefix, expires_at FROM prompt_cache
+               WHERE scope = ? AND expires_at > ? AND substr(?, 1, length(prefix)) = prefix
+               ORDER BY length(prefix) DESC LIMIT 1""",
+            (scope, now, prefix)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "scope": scope, "prefix": row[1], "expires_at": row[2]}
+
+    def put(self, entry):
+        with self.store.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO prompt_cache VALUES (?, ?, ?, ?, ?)",
+                (entry["name"], entry["scope"], entry["prefix"], entry["expires_at"], time.time())
+            )
+
+    def touch(self, name, expires_at=None):
+        now = time.time()
+        if expires_at is None and now - self._touched.get(name, 0) < TOUCH_INTERVAL_SECONDS:
+            return
+        self._touched[name] = now
+        with self.store.transaction() as conn:
+            conn.execute(
+                "UPDATE prompt_cache SET last_used = ?, expires_at = COALESCE(?, expires_at) WHERE name = ?",
+                (time.time(), expires_at, name)
+            )
+
+    def remove(self, name):
+        self._touched.pop(name, None)
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM prompt_cache WHERE name = ?", (name,))
+
+    def drop_expired(self, now):
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM prompt_cache WHERE expires_at <= ?", (now,))
+
+    def least_recent(self, keep):
+        rows = self.store.connect().execute(
+            "SELECT name FROM prompt_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+            (keep,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def names(self):
+        return [row[0] for row in self.store.connect().execute("SELECT name FROM prompt_cache")]
+
+
+class PromptCache:
+    """
+    Tracks cached-content handles per (namespace, instructions, prefix).
+
+    A handle for prefix P also serves any later prefix that starts with P;
+    the difference is sent inline. Once that inline tail grows past
+    min_chars, a new handle is created for the longer prefix.
+
+    Handles are billed for creation and storage, so one is only created
+    when it is likely to be reused: the same prefix (or an earlier version
+    of it) was already seen within the TTL. Creating and refreshing happen
+    on a background thread; the call that triggers them goes inline.
+    """
+
+    def __init__(self, backend, model=GEMINI_MODEL, ttl_seconds=TTL_SECONDS,
+                 min_chars=MIN_CHARS, max_entries=MAX_ENTRIES, registry=None):
+        self.backend = backend
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.min_chars = min_chars
+        self.max_entries = max_entries
+        self.registry = registry or MemoryRegistry()
+        self._failed_until = {}          # scope -> timestamp
+        self._min_size = {}              # scope -> smallest size worth trying, learned from rejections
+        self._in_flight = set()          # (scope, prefix digest) being created right now
+        self._seen = OrderedDict()       # (scope, prefix head digest) -> last seen, per process
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prompt-cache")
+        self._lock = threading.Lock()    # guards the registry and the dicts above, never held upstream
+
+    def prepare(self, namespace, system_instruction, prefix="", contents=(), **config):
+        """
+        Build (contents, GenerateContentConfig) for a call whose prompt is
+        system_instruction + prefix + contents, using a cached handle for the
+        longest prefix we have one for.
+        """
+        import google.genai.types as types
+
+        name, tail = self.resolve(namespace, system_instruction, prefix)
+        request_contents = ([tail] if tail else []) + list(contents)
+
+        if name:
+            return request_contents, types.GenerateContentConfig(cached_content=name, **config)
+        return request_contents, types.GenerateContentConfig(
+            system_instruction=system_instruction, **config
+        )
+
+    def generate(self, client, namespace, system_instruction, prefix="", contents=(), **config):
+        """
+        prepare() and call generate_content, waiting on the Gemini rate limiter
+        first. If the cached handle no longer exists upstream (expired, or
+        evicted by another worker) it is forgotten and the call is retried
+        once with everything inline.
+        """
+        import google.genai.types as types
+
+        request_contents, request_config = self.prepare(
+            namespace, system_instruction, prefix, contents, **config
+        )
+        gemini_limiter.acquire()
+        try:
+            return client.models.generate_content(
+                model=self.model, contents=request_contents, config=request_config
+            )
+        except Exception as e:
+            name = request_config.cached_content
+            if not name or not _is_missing_handle(e):
+                raise
+            print(f"Prompt cache handle {name} is gone upstream, retrying inline: {e}")
+            with self._lock:
+                self.registry.remove(name)
+
+        gemini_limiter.acquire()
+        return client.models.generate_content(
+            model=self.model,
+            contents=([prefix] if prefix else []) + list(contents),
+            config=types.GenerateContentConfig(system_instruction=system_instruction, **config)
+        )
+
+    def resolve(self, namespace, system_instruction, prefix=""):
+        """
+        Return (cached_content_name, uncached_tail). The name is None when
+        nothing suitable is cached and the prompt is too small to cache.
+        """
+        if self.backend is None:
+            return None, prefix
+
+        scope = f"{namespace}:{_digest(system_instruction)}"
+        key = (scope, _digest(prefix))
+        size = len(system_instruction) + len(prefix)
+        now = time.time()
+
+        with self._lock:
+            entry = self.registry.longest_match(scope, prefix, now)
+            tail_chars = len(prefix) - len(entry["prefix"]) if entry else len(prefix)
+            seen_recently = self._sighted(scope, prefix, now)
+
+            create = seen_recently \
+                and size >= max(self.min_chars, self._min_size.get(scope, 0)) \
+                and (entry is None or tail_chars >= self.min_chars) \
+                and self._failed_until.get(scope, 0) <= now \
+                and key not in self._in_flight
+            if create:
+                self._in_flight.add(key)
+
+            refresh = entry is not None \
+                and entry["expires_at"] - now < REFRESH_MARGIN_SECONDS \
+                and ("refresh", entry["name"]) not in self._in_flight
+            if refresh:
+                self._in_flight.add(("refresh", entry["name"]))
+            elif entry is not None:
+                self.registry.touch(entry["name"])
+
+        # Upstream round-trips never sit in a user's request: this call uses
+        # what's cached now, and the next one picks up the new handle
+        if create:
+            self._executor.submit(self._create, key, scope, namespace, system_instruction, prefix)
+        if refresh:
+            self._executor.submit(self._refresh, entry["name"])
+
+        if entry is None:
+            return None, prefix
+        return entry["name"], prefix[len(entry["prefix"]):]
+
+    def clear(self):
+        """Delete every handle in the registry."""
+        with self._lock:
+            names = self.registry.names()
+            for name in names:
+                self.registry.remove(name)
+        for name in names:
+            self._delete_upstream(name)
+
+    # ─── Internals ───────────────────────────────────────────────
+
+    def _sighted(self, scope, prefix, now):
+        """
+        Record a call with this prefix and say whether the same prefix, or a
+        shorter version of it, was seen within the TTL (caller holds the lock).
+        """
+        fingerprint = (scope, _digest(prefix[:FINGERPRINT_CHARS]))
+        last_seen = self._seen.pop(fingerprint, None)
+        self._seen[fingerprint] = now
+        while len(self._seen) > MAX_SIGHTINGS:
+            self._seen.popitem(last=False)
+        return last_seen is not None and now - last_seen < self.ttl_seconds
+
+    def _refresh(self, name):
+        """Extend a handle's TTL (background thread)."""
+        try:
+            self.backend.refresh(name, self.ttl_seconds)
+            with self._lock:
+                self.registry.touch(name, time.time() + self.ttl_seconds)
+        except Exception as e:
+            print(f"Prompt cache refresh failed for {name}: {e}")
+            with self._lock:
+                self.registry.remove(name)
+        finally:
+            with self._lock:
+                self._in_flight.discard(("refresh", name))
+
+    def _create(self, key, scope, namespace, system_instruction, prefix):
+        """Create a handle for prefix (background thread)."""
+        try:
+            self._create_handle(scope, namespace, system_instruction, prefix, time.time())
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def _create_handle(self, scope, namespace, system_instruction, prefix, now):
+        try:
+            name = self.backend.create(
+                self.model,
+                system_instruction,
+                [prefix] if prefix else [],
+                self.ttl_seconds,
+                display_name=f"morytale-{namespace}"
+            )
+        except Exception as e:
+            print(f"Prompt cache create failed for '{namespace}', sending inline: {e}")
+            with self._lock:
+                if _is_too_small(e):
+                    # Only this prompt's size is the problem: raise the bar for
+                    # the scope instead of turning caching off for every track
+                    size = len(system_instruction) + len(prefix)
+                    self._min_size[scope] = max(self._min_size.get(scope, 0), size + 1)
+                else:
+                    self._failed_until[scope] = now + FAILURE_BACKOFF_SECONDS
+            return None
+
+        entry = {"name": name, "scope": scope, "prefix": prefix, "expires_at": now + self.ttl_seconds}
+        with self._lock:
+            # Expired rows are skipped by longest_match and only purged here,
+            # not on every generation call
+            self.registry.drop_expired(now)
+            self.registry.put(entry)
+            stale = self.registry.least_recent(self.max_entries)
+            for old in stale:
+                self.registry.remove(old)
+        for old in stale:
+            self._delete_upstream(old)
+        return entry
+
+    def _delete_upstream(self, name):
+        try:
+            self.backend.delete(name)
+        except Exception as e:
+            print(f"Prompt cache delete failed for {name}: {e}")
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def _is_missing_handle(error):
+    """Gemini's error for a cached_content that expired or was deleted."""
+    return getattr(error, "code", None) in (400, 403, 404) and "cache" in str(error).lower()
+
+
+def _is_too_small(error):
+    """Gemini's rejection of a cache below the model's minimum token count."""
+    message = str(error).lower()
+    return "too small" in message or "min_total_token_count" in message
+
+
+def create_prompt_cache(client):
+    """
+    Build a PromptCache using the backend selected by ML_PROMPT_CACHE.
+    Handles are tracked in the shared store when one is configured, so
+    workers reuse each other's handles instead of each creating their own.
+    """
+    store = get_store()
+    registry = SqliteRegistry(store) if store is not None else MemoryRegistry()
+
+    if BACKEND == "off":
+        return PromptCache(None)
+    if BACKEND == "local":
+        return PromptCache(LocalCacheBackend(), registry=MemoryRegistry())
+    return PromptCache(GeminiCacheBackend(client), registry=registry)
@@ -0,0 +1,67 @@
+"""
+Rate limiter — keep Gemini calls under the account's requests-per-minute.
+
+A sliding one-minute window. In multi-worker mode the window lives in the
+shared SQLite store, so the budget is global to the host rather than
+multiplied by the number of workers.
+"""
+
+from collections import deque
+import threading
+import time
+
+from config import setting
+from sharedState import get_store
+
+GEMINI_RPM = setting("ML_GEMINI_RPM", 0)   # 0 disables limiting
+WINDOW_SECONDS = 60
+
+
+class RateLimiter:
+    """Blocks in acquire() until a call fits in the current window."""
+
+    def __init__(self, bucket, per_minute, store=None):
+        self.bucket = bucket
+        self.per_minute = per_minute
+        self.store = store
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserve one call, sleeping until the window has room."""
+        if self.per_minute <= 0:
+            return
+        while True:
+            wait = self._try_acquire(time.time())
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _try_acquire(self, now):
+        """Record a call and return 0, or return how long to wait."""
+        if self.store is None:
+            with self._lock:
+                while self._events and self._events[0] <= now - WINDOW_SECONDS:
+                    self._events.popleft()
+                if len(self._events) < self.per_minute:
+                    self._events.append(now)
+                    return 0
+                return self._events[0] + WINDOW_SECONDS - now
+
+        with self.store.transaction(immediate=True) as conn:
+            conn.execute(
+                "DELETE FROM rate_events WHERE bucket = ? AND ts <= ?",
+                (self.bucket, now - WINDOW_SECONDS)
+            )
+            count, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(ts) FROM rate_events WHERE bucket = ?",
+                (self.bucket,)
+            ).fetchone()
+            if count < self.per_minute:
+                conn.execute("INSERT INTO rate_events (bucket, ts) VALUES (?, ?)", (self.bucket, now))
+                return 0
+            return oldest + WINDOW_SECONDS - now
+
+
+# Shared by every module that calls Gemini.
+gemini_limiter = RateLimiter("gemini", GEMINI_RPM, store=get_store())
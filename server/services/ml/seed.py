@@ -5,38 +5,35 @@ from the Sparkhack_photos folder.
 Splits 18 images into 3 batches of 6 to stay under Gemini RPM limits.
 Each image is sent individually for description + embedding, then inserted
 into MongoDB as an Item document owned by one of 3 dummy seed users.
+Near-duplicate images (by perceptual hash) reuse an existing item's
+description and embedding instead of making new Gemini calls.
 
 Usage:
     cd server/services/ml
     python seed.py
 """
 
-import google.genai as genai
-import google.genai.types as types
-from pymongo import MongoClient
 from bson import ObjectId
 from pathlib import Path
-from dotenv import load_dotenv
 from datetime import datetime
-import os
 import time
 import mimetypes
 
+from config import EMBEDDING_MODEL, ensure_indexes, get_client, get_db, get_prompt_cache
+from imageIndex import ImageHashIndex, hash_to_hex, hex_to_hash
+from rateLimiter import gemini_limiter
+from imageWorker import image_hash
+
 # ─── Config ───────────────────────────────────────────────────────
-load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env')
 
 PHOTOS_DIR = Path(__file__).resolve().parent.parent.parent.parent.parent / 'Sparkhack_photos'
 BATCH_SIZE = 9               # 18 photos ÷ 3 batches
 BATCH_DELAY_SECONDS = 65      # Wait between batches to reset RPM window
 INTRA_BATCH_DELAY = 30         # Small delay between images within a batch
 SUPPORTED_MIME_TYPES = {'image/jpeg', 'image/png'}
+SEED_OWNER = "seed"            # seed users' photos dedupe against each other
 
-# Gemini client
-client = genai.Client(api_key=os.environ.get("GOOGLE_GEMINI_API"))
-
-# MongoDB
-mongo_client = MongoClient(os.environ.get("MONGODB_URI"))
-db = mongo_client["cutting-room"]
+# Gemini client and MongoDB come from config (connected on first use)
 
 # ─── Prompt (same as imgParsing.py) ───────────────────────────────
 description_prompt = """
@@ -75,15 +72,22 @@ def create_seed_users(count: int = 3) -> list[ObjectId]:
     Create (or reuse) dummy seed users so items have valid user_id refs.
     Returns a list of ObjectIds.
     """
+    db = get_db()
+    usernames = [f"seed_user_{i}" for i in range(1, count + 1)]
+
+    # One query for all seed users instead of one per user
+    existing = {
+        user["username"]: user["_id"]
+        for user in db.users.find({"username": {"$in": usernames}}, {"username": 1})
+    }
+
     user_ids = []
-    for i in range(1, count + 1):
-        username = f"seed_user_{i}"
+    for i, username in enumerate(usernames, start=1):
         email = f"seed{i}@cuttingroom.dev"
 
-        existing = db.users.find_one({"username": username})
-        if existing:
-            user_ids.append(existing["_id"])
-            print(f"  Reusing existing seed user: {username} ({existing['_id']})")
+        if username in existing:
+            user_ids.append(existing[username])
+            print(f"  Reusing existing seed user: {username} ({existing[username]})")
         else:
             result = db.users.insert_one({
                 "username": username,
@@ -98,43 +102,92 @@ def create_seed_users(count: int = 3) -> list[ObjectId]:
     return user_ids
 
 
-def process_single_image(image_path: Path) -> dict:
+def load_image_index() -> ImageHashIndex:
+    """
+    Build a perceptual-hash index from items already in the database.
+    Embeddings are large (3072 floats), so only the item id is kept and the
+    embedding is fetched when a near-duplicate actually matches.
+    """
+    index = ImageHashIndex()
+    for item in get_db().items.find(
+        {"phash": {"$ne": None}, "description": {"$ne": None}},
+        {"phash": 1, "description": 1}
+    ):
+        index.add(hex_to_hash(item["phash"]), {
+            "description": item["description"],
+            "item_id": item["_id"]
+        }, owner=SEED_OWNER)
+    return index
+
+
+def get_item_embedding(item_id: ObjectId) -> list:
+    """Fetch just the embedding of one item."""
+    item = get_db().items.find_one({"_id": item_id}, {"embedding": 1, "_id": 0})
+    return (item or {}).get("embedding") or []
+
+
+def process_single_image(image_path: Path, index: ImageHashIndex) -> dict:
     """
     Send one image to Gemini for description, then get its embedding.
-    Returns { description, embedding } or raises on failure.
+    Near-duplicates of an indexed image reuse its description and embedding.
+    Returns { description, embedding, phash, reused } or raises on failure.
     """
+    import google.genai.types as types
+
     mime_type, _ = mimetypes.guess_type(str(image_path))
 
     with open(image_path, 'rb') as f:
         image_bytes = f.read()
 
-    # Step 1: Generate description
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[
-            types.Part.from_bytes(
-                data=image_bytes,
-                mime_type=mime_type,
-            ),
-            description_prompt
-        ]
-    )
+    # Step 0: Skip Gemini entirely for near-duplicates
+    try:
+        hash_value = image_hash(image_bytes)
+    except Exception as e:
+        print(f"         Could not hash image: {e}")
+        hash_value = None
+
+    match, distance = index.find(hash_value, owner=SEED_OWNER)
+    embedding = None
+    if match:
+        embedding = match.get("embedding") or get_item_embedding(match["item_id"])
+    if embedding:
+        print(f"         Near-duplicate (distance {distance}), reusing description")
+        return {
+            "description": match["description"],
+            "embedding": embedding,
+            "phash": hash_to_hex(hash_value),
+            "reused": True
+        }
+
+    # Step 1: Generate description (static prompt goes through the prompt cache)
+    response = get_prompt_cache().generate(get_client(), "description", description_prompt, contents=[
+        types.Part.from_bytes(
+            data=image_bytes,
+            mime_type=mime_type,
+        )
+    ])
     description = response.text.strip()
 
     # Step 2: Generate embedding from description
-    embed_response = client.models.embed_content(
-        model="gemini-embedding-001",
+    gemini_limiter.acquire()
+    embed_response = get_client().models.embed_content(
+        model=EMBEDDING_MODEL,
         contents=description
     )
     embedding = list(embed_response.embeddings[0].values)
 
+    index.add(hash_value, {"description": description, "embedding": embedding}, owner=SEED_OWNER)
+
     return {
         "description": description,
-        "embedding": embedding
+        "embedding": embedding,
+        "phash": hash_to_hex(hash_value) if hash_value is not None else None,
+        "reused": False
     }
 
 
-def insert_item(user_id: ObjectId, image_path: Path, description: str, embedding: list) -> ObjectId:
+def insert_item(user_id: ObjectId, image_path: Path, description: str, embedding: list,
+                phash: str | None = None) -> ObjectId:
     """Insert a single item document into MongoDB."""
     doc = {
         "user_id": user_id,
@@ -144,9 +197,10 @@ def insert_item(user_id: ObjectId, image_path: Path, description: str, embedding
         "caption": description[:90] if description else None,  # max 90 chars
         "description": description,
         "embedding": embedding,
+        "phash": phash,                   # dHash hex, for near-duplicate lookup
         "created_at": datetime.utcnow()
     }
-    result = db.items.insert_one(doc)
+    result = get_db().items.insert_one(doc)
     return result.inserted_id
 
 
@@ -157,6 +211,8 @@ def seed():
     print("  The Cutting Room — Seed Script")
     print("=" * 60)
 
+    ensure_indexes()
+
     # 1. Collect images
     images = get_supported_images(PHOTOS_DIR)
     print(f"\nFound {len(images)} supported images in {PHOTOS_DIR}")
@@ -177,6 +233,9 @@ def seed():
 
     print(f"\nSplit {len(images)} images into {len(batches)} batches of up to {BATCH_SIZE}")
 
+    index = load_image_index()
+    print(f"Loaded {len(index)} existing image hashes for near-duplicate lookup")
+
     # 4. Process each batch
     total_inserted = 0
     for batch_idx, batch in enumerate(batches):
@@ -190,10 +249,12 @@ def seed():
             filename = image_path.name
             print(f"\n  [{img_idx + 1}/{len(batch)}] Processing: {filename}")
 
+            reused = False
             try:
-                result = process_single_image(image_path)
+                result = process_single_image(image_path, index)
                 description = result["description"]
                 embedding = result["embedding"]
+                reused = result["reused"]
 
                 # Print truncated description
                 preview = description[:100] + "..." if len(description) > 100 else description
@@ -201,7 +262,7 @@ def seed():
                 print(f"         Embedding dims: {len(embedding)}")
 
                 # Insert into MongoDB
-                item_id = insert_item(user_id, image_path, description, embedding)
+                item_id = insert_item(user_id, image_path, description, embedding, result["phash"])
                 print(f"         Inserted as item: {item_id}")
                 total_inserted += 1
 
@@ -209,8 +270,8 @@ def seed():
                 print(f"         ERROR: {e}")
                 print(f"         Skipping {filename}")
 
-            # Small delay between images within the batch
-            if img_idx < len(batch) - 1:
+            # Small delay between images within the batch (near-duplicates made no calls)
+            if img_idx < len(batch) - 1 and not reused:
                 time.sleep(INTRA_BATCH_DELAY)
 
         # Wait between batches (except after the last one)
@@ -219,7 +280,7 @@ def seed():
             time.sleep(BATCH_DELAY_SECONDS)
 
     # 5. Summary
-    total_items = db.items.count_documents({})
+    total_items = get_db().items.estimated_document_count()
     print(f"\n{'=' * 60}")
     print(f"  Seed complete!")
     print(f"  Inserted: {total_inserted}/{len(images)} items")
@@ -1,26 +1,107 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
 from pathlib import Path
-from dotenv import load_dotenv
+import urllib.request
 import tempfile
+import asyncio
+import base64
+import hashlib
 import os
 
-# Load .env from server directory
-load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env')
+import config
+from storyGeneration import (
+    generate_story_from_image,
+    generate_story_from_text,
+    generate_story_from_description,
+    generate_stories_from_texts,
+    FALLBACK_IMAGE_DESCRIPTION,
+)
+from trackConclusion import (
+    generate_conclusion,
+    generate_community_reflection,
+    generate_community_reflection_from_summary,
+)
+from imageIndex import ImageHashIndex
+from sharedState import get_store
+import imageWorker
 
-from storyGeneration import generate_story_from_image, generate_story_from_text
-from trackConclusion import generate_conclusion, generate_community_reflection
+# /story-batch limits
+BATCH_MAX_JOBS = config.setting("ML_BATCH_MAX_JOBS", 100)
+BATCH_CONCURRENCY = config.setting("ML_BATCH_CONCURRENCY", 4)       # Gemini calls in flight per batch
+PACK_MAX_CHARS = config.setting("ML_BATCH_PACK_MAX_CHARS", 1500)    # text + story_so_far per packed job
+PACK_SIZE = config.setting("ML_BATCH_PACK_SIZE", 8)                 # text jobs per multi-output call
+MAX_IMAGE_BYTES = config.setting("ML_MAX_IMAGE_BYTES", 20 * 1024 * 1024)
+# Hosts an image_url may point at; defaults to the R2 public bucket domain.
+# Empty means image_url jobs are refused.
+IMAGE_URL_HOSTS = {
+    host.strip().lower()
+    for host in config.setting(
+        "ML_IMAGE_URL_HOSTS", urlparse(os.environ.get("R2_PUBLIC_URL", "")).hostname or ""
+    ).split(",")
+    if host.strip()
+}
 
-app = FastAPI(title="Cutting Room ML Service")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Runs before uvicorn opens the port. Warm the image pool first (it forks),
+    # then import google.genai and open the upstream connection, so the first
+    # request doesn't pay for any of it.
+    imageWorker.start_pool()
+    await run_in_threadpool(config.warm_up)
+    yield
+    imageWorker.shutdown_pool()
+
+
+app = FastAPI(title="Cutting Room ML Service", lifespan=lifespan)
+
+# Descriptions of images we've already sent to the vision model, keyed by dHash.
+# Shared across workers when ML_SHARED_STATE_PATH is set.
+image_index = ImageHashIndex(store=get_store())
 
 
 # These endpoints do ML work ONLY. No database writes, no track/node
 # management. The Node.js server handles all orchestration.
+# Gemini calls block (and may wait on the rate limiter), so they run in the
+# threadpool to keep the event loop free for other requests.
+
+
+async def _story_for_image(image_bytes, mime_type, story_so_far, user_id=None):
+    """
+    Preprocess an image, then describe it (or reuse a near-duplicate's
+    description). user_id scopes near-duplicate matches to the uploader;
+    without one the index is skipped.
+    """
+    sha256 = await run_in_threadpool(lambda: hashlib.sha256(image_bytes).hexdigest())
+    image_bytes, mime_type, image_hash = await imageWorker.prepare_image(image_bytes, mime_type)
+
+    # Near-duplicate of an image we've already described: skip the vision call.
+    # The index reads (and writes) the shared SQLite store, so it stays off the event loop.
+    match, distance = await run_in_threadpool(
+        image_index.find, image_hash, owner=user_id, sha256=sha256
+    )
+    if match:
+        print(f"Reusing description of near-duplicate image (distance {distance})")
+        return await run_in_threadpool(
+            generate_story_from_description, match["description"], story_so_far
+        )
+
+    result = await run_in_threadpool(generate_story_from_image, image_bytes, mime_type, story_so_far)
+    if result.get("description") not in (None, "", FALLBACK_IMAGE_DESCRIPTION):
+        await run_in_threadpool(
+            image_index.add, image_hash, {"description": result["description"]},
+            owner=user_id, sha256=sha256
+        )
+    return result
 
 
 @app.post("/api/ml/story-from-image")
 async def story_from_image_endpoint(
     file: UploadFile = File(...),
-    story_so_far: str = Form("")
+    story_so_far: str = Form(""),
+    user_id: str = Form("")
 ):
     """Generate story segment directly from image."""
     # Accept any image format
@@ -33,8 +114,7 @@ async def story_from_image_endpoint(
     image_bytes = await file.read()
 
     try:
-        result = generate_story_from_image(image_bytes, file.content_type, story_so_far)
-        return result
+        return await _story_for_image(image_bytes, file.content_type, story_so_far, user_id or None)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -51,7 +131,7 @@ async def story_from_text_endpoint(body: dict):
         raise HTTPException(status_code=400, detail="text is required")
 
     try:
-        result = generate_story_from_text(text, story_so_far)
+        result = await run_in_threadpool(generate_story_from_text, text, story_so_far)
         return result
     except Exception as e:
         import traceback
@@ -59,21 +139,176 @@ async def story_from_text_endpoint(body: dict):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _check_image_url(url):
+    """Only the configured image hosts may be fetched (no localhost, metadata endpoints, ...)."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or (parsed.hostname or "") not in IMAGE_URL_HOSTS:
+        raise ValueError(f"image_url '{url}' is not on an allowed image host")
+
+
+class _ImageRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only while they stay on an allowed image host."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_image_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_image_opener = urllib.request.build_opener(_ImageRedirectHandler)
+
+
+def _fetch_image(url):
+    """Download an image reference (an R2 public URL). Returns (bytes, mime_type)."""
+    _check_image_url(url)
+    with _image_opener.open(url, timeout=30) as res:
+        mime_type = res.headers.get_content_type()
+        if not mime_type.startswith("image/"):
+            raise ValueError(f"'{url}' is not an image ({mime_type})")
+        image_bytes = res.read(MAX_IMAGE_BYTES + 1)
+        if len(image_bytes) > MAX_IMAGE_BYTES:
+            raise ValueError(f"image at '{url}' is larger than {MAX_IMAGE_BYTES} bytes")
+        return image_bytes, mime_type
+
+
+def _decode_image_base64(data):
+    """Strictly decode an image_base64 payload; garbage or empty input is an error."""
+    try:
+        image_bytes = base64.b64decode(data, validate=True)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid image_base64: {e}")
+    if not image_bytes:
+        raise ValueError("image_base64 is empty")
+    return image_bytes
+
+
+def _validate_job(job):
+    """Raise ValueError unless job is an object whose fields are all strings."""
+    if not isinstance(job, dict):
+        raise ValueError("job must be an object")
+    for field in ("text", "story_so_far", "image_url", "image_base64", "mime_type", "user_id"):
+        if job.get(field) is not None and not isinstance(job[field], str):
+            raise ValueError(f"{field} must be a string")
+
+
+def _is_packable(job):
+    """Short, valid text jobs can share one multi-output LLM call."""
+    try:
+        _validate_job(job)
+    except ValueError:
+        return False    # run_single reports it
+    text = job.get("text")
+    return bool(text) and len(text) + len(job.get("story_so_far") or "") <= PACK_MAX_CHARS
+
+
+async def _story_for_job(job):
+    """Run one /story-batch job on its own."""
+    story_so_far = job.get("story_so_far") or ""
+
+    if job.get("text"):
+        return await run_in_threadpool(generate_story_from_text, job["text"], story_so_far)
+
+    if job.get("image_url"):
+        # The host's Content-Type is authoritative for fetched images
+        image_bytes, mime_type = await run_in_threadpool(_fetch_image, job["image_url"])
+    elif job.get("image_base64"):
+        image_bytes = _decode_image_base64(job["image_base64"])
+        mime_type = job.get("mime_type") or "image/jpeg"
+    else:
+        raise ValueError("job needs one of text, image_url or image_base64")
+
+    if not mime_type.startswith("image/"):
+        raise ValueError(f"invalid image type '{mime_type}'")
+    return await _story_for_image(image_bytes, mime_type, story_so_far, job.get("user_id") or None)
+
+
+@app.post("/api/ml/story-batch")
+async def story_batch_endpoint(body: dict):
+    """
+    Generate story segments for many independent jobs (backfills).
+
+    Each job is {text | image_url | image_base64, story_so_far, mime_type?, user_id?}.
+    image_url must be on ML_IMAGE_URL_HOSTS; mime_type applies to image_base64.
+    Results come back in job order; a failed job leaves None in results and
+    an {index, error} entry in errors. Short text jobs are packed several to
+    a Gemini call; everything else runs one call per job, BATCH_CONCURRENCY
+    at a time.
+    """
+    jobs = body.get("jobs")
+    if not isinstance(jobs, list) or not jobs:
+        raise HTTPException(status_code=400, detail="jobs must be a non-empty list")
+    if len(jobs) > BATCH_MAX_JOBS:
+        raise HTTPException(status_code=400, detail=f"at most {BATCH_MAX_JOBS} jobs per batch")
+
+    results = [None] * len(jobs)
+    errors = []
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_single(i):
+        async with semaphore:
+            try:
+                _validate_job(jobs[i])
+                results[i] = await _story_for_job(jobs[i])
+            except Exception as e:
+                errors.append({"index": i, "error": str(e)})
+
+    async def run_packed(indices):
+        async with semaphore:
+            try:
+                outputs = await run_in_threadpool(generate_stories_from_texts, [
+                    (jobs[i]["text"], jobs[i].get("story_so_far") or "") for i in indices
+                ])
+            except Exception as e:
+                print(f"Packed story call failed, retrying {len(indices)} jobs individually: {e}")
+                outputs = [None] * len(indices)
+
+        # Anything the packed call didn't answer gets its own call
+        retries = []
+        for i, output in zip(indices, outputs):
+            if output:
+                results[i] = output
+            else:
+                retries.append(run_single(i))
+        await asyncio.gather(*retries)
+
+    packable = [i for i, job in enumerate(jobs) if _is_packable(job)]
+    groups = [packable[g:g + PACK_SIZE] for g in range(0, len(packable), PACK_SIZE)]
+    packed = set(packable)
+
+    await asyncio.gather(
+        *[run_packed(group) if len(group) > 1 else run_single(group[0]) for group in groups],
+        *[run_single(i) for i in range(len(jobs)) if i not in packed]
+    )
+
+    errors.sort(key=lambda e: e["index"])
+    return {"results": results, "errors": errors}
+
+
 @app.post("/api/ml/generate-conclusion")
 async def generate_conclusion_endpoint(body: dict):
-    """Generate a track conclusion + community reflection. Pure LLM calls."""
+    """
+    Generate a track conclusion + community reflection. Pure LLM calls.
+    A precomputed cluster_summary (see storyClusters.py) takes precedence
+    over similar_stories.
+    """
     story = body.get("story", "")
     similar_stories = body.get("similar_stories", [])
+    cluster_summary = body.get("cluster_summary", "")
 
     if not story:
         raise HTTPException(status_code=400, detail="story is required")
 
     try:
-        conclusion = generate_conclusion(story)
+        conclusion = await run_in_threadpool(generate_conclusion, story)
 
         community_reflection = ""
-        if similar_stories:
-            community_reflection = generate_community_reflection(story, similar_stories)
+        if cluster_summary:
+            community_reflection = await run_in_threadpool(
+                generate_community_reflection_from_summary, story, cluster_summary
+            )
+        elif similar_stories:
+            community_reflection = await run_in_threadpool(
+                generate_community_reflection, story, similar_stories
+            )
 
         return {
             "conclusion": conclusion,
@@ -89,5 +324,23 @@ async def health():
 
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8008)
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Cutting Room ML Service")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("ML_WORKERS", 1)))
+    parser.add_argument("--port", type=int, default=8008)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # Each worker is its own process. Point them all at one SQLite file so
+        # the rate budget, prompt cache handles and image index are host-wide,
+        # and split the cores between their image pools.
+        os.environ.setdefault(
+            "ML_SHARED_STATE_PATH",
+            str(Path(tempfile.gettempdir()) / "morytale-ml-state.sqlite3")
+        )
+        os.environ.setdefault("ML_IMAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // args.workers)))
+        uvicorn.run("server:app", host="0.0.0.0", port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=args.port)
\ No newline at end of file
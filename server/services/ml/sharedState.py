@@ -0,0 +1,93 @@
+"""
+Shared state — one SQLite database for every worker process on the host.
+
+With `python server.py --workers N` each uvicorn worker is its own process,
+so anything kept in module globals (near-duplicate index, prompt cache
+handles, Gemini rate budget) would be per worker. When ML_SHARED_STATE_PATH
+is set, those components keep their state here instead. SQLite in WAL mode
+handles concurrent readers and short write transactions from a handful of
+local processes without any extra service.
+
+Unset (the single-process default) means everything stays in memory.
+"""
+
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+from config import setting
+
+SHARED_STATE_PATH = setting("ML_SHARED_STATE_PATH", None)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,   -- monotonic, so workers can pull new rows
+    hash INTEGER NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS prompt_cache (
+    name TEXT PRIMARY KEY,
+    scope TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prompt_cache_scope ON prompt_cache (scope);
+
+CREATE TABLE IF NOT EXISTS rate_events (
+    bucket TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_events_bucket_ts ON rate_events (bucket, ts);
+"""
+
+
+class SharedStore:
+    """SQLite-backed store with one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self.connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transaction() issues BEGIN/COMMIT explicitly.
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Run a block in one transaction. immediate=True takes the write lock
+        up front, for read-then-write sequences that must not interleave
+        with other processes.
+        """
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The host-wide SharedStore, or None when running single-process."""
+    global _store
+    if _store is None and SHARED_STATE_PATH:
+        with _store_lock:
+            if _store is None:
+                _store = SharedStore(SHARED_STATE_PATH)
+    return _store
@@ -0,0 +1,218 @@
+"""
+Story Clusters — Precompute per-week clusters of track stories for
+community reflections.
+
+Embeds every track story from one week, groups them with k-means and asks
+Gemini once per cluster for a short theme summary. Each track gets a
+story_cluster_id, so concluding a track can send its cluster's summary to
+the ML service instead of several other people's full stories.
+
+Tracks still in progress are clustered too, so run this periodically during
+the week (e.g. daily); a track that isn't in a cluster yet falls back to the
+old similar-stories reflection. Re-running rebuilds the week's clusters and
+reuses the summary of any cluster whose members and their stories didn't
+change.
+
+Usage:
+    cd server/services/ml
+    python storyClusters.py [week_id]      # defaults to the current ISO week
+"""
+
+from datetime import datetime
+import hashlib
+import math
+import sys
+
+import numpy as np
+
+from config import EMBEDDING_MODEL, ensure_indexes, get_client, get_db
+from rateLimiter import gemini_limiter
+from trackConclusion import generate_cluster_summary
+
+# ─── Config ───────────────────────────────────────────────────────
+MAX_CLUSTERS = 12
+MIN_CLUSTER_SIZE = 3          # each member's reflection draws on at least two other people
+EMBED_BATCH_SIZE = 100        # stories per embed_content call
+EMBED_MAX_CHARS = 8000        # embedding input limit is ~2048 tokens
+SUMMARY_STORIES = 5           # stories closest to the centroid sent for the summary
+SUMMARY_STORY_MAX_CHARS = 1500
+KMEANS_ITERATIONS = 50
+
+
+# ─── Helpers ──────────────────────────────────────────────────────
+
+def get_week_id():
+    """Get current ISO week string e.g. '2026-W06'."""
+    iso = datetime.now().isocalendar()
+    return f"{iso[0]}-W{iso[1]:02d}"
+
+
+def get_week_stories(week_id):
+    """Return [(track_id, story)] for every track this week with a story."""
+    tracks = get_db().tracks.find(
+        {"week_id": week_id, "story": {"$nin": [None, ""]}},
+        {"story": 1}
+    )
+    return [(t["_id"], t["story"]) for t in tracks]
+
+
+def embed_stories(stories):
+    """Embed stories in batches. Returns an (n, dims) array of unit vectors."""
+    vectors = []
+    for start in range(0, len(stories), EMBED_BATCH_SIZE):
+        batch = [s[:EMBED_MAX_CHARS] for s in stories[start:start + EMBED_BATCH_SIZE]]
+        gemini_limiter.acquire()
+        response = get_client().models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=batch
+        )
+        vectors.extend(e.values for e in response.embeddings)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def choose_k(n):
+    """Rule-of-thumb cluster count: sqrt(n/2), capped."""
+    return max(1, min(MAX_CLUSTERS, n // MIN_CLUSTER_SIZE, round(math.sqrt(n / 2))))
+
+
+def kmeans(vectors, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Vectorized k-means with k-means++ seeding.
+    Returns (labels, centroids).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    sq_norms = (vectors ** 2).sum(axis=1)
+
+    # k-means++: each new centroid is picked with probability ∝ squared distance
+    centroids = np.empty((k, vectors.shape[1]), dtype=vectors.dtype)
+    centroids[0] = vectors[rng.integers(n)]
+    closest = ((vectors - centroids[0]) ** 2).sum(axis=1)
+    for c in range(1, k):
+        total = closest.sum()
+        probs = closest / total if total > 0 else np.full(n, 1 / n)
+        centroids[c] = vectors[rng.choice(n, p=probs)]
+        closest = np.minimum(closest, ((vectors - centroids[c]) ** 2).sum(axis=1))
+
+    labels = None
+    for _ in range(iterations):
+        # ||x - c||² = ||x||² - 2x·c + ||c||², for all pairs at once
+        distances = sq_norms[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        new_labels = distances.argmin(axis=1)
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+        one_hot = np.eye(k, dtype=vectors.dtype)[labels]
+        counts = one_hot.sum(axis=0)
+        nonempty = counts > 0
+        centroids[nonempty] = (one_hot.T @ vectors)[nonempty] / counts[nonempty, None]
+
+    return labels, centroids
+
+
+def stories_digest(track_ids, stories):
+    """Digest of a cluster's (track, story) pairs; changes when any member's story grows."""
+    digest = hashlib.sha256()
+    for track_id, story in sorted(zip(map(str, track_ids), stories)):
+        digest.update(f"{track_id}\0{story}\0".encode())
+    return digest.hexdigest()
+
+
+def representative_stories(member_idx, vectors, centroid, stories):
+    """
+    The SUMMARY_STORIES member stories closest to the centroid (every member
+    of a small cluster), each cut to the median length of the group so one
+    long story can't dominate the summary.
+    """
+    distances = ((vectors[member_idx] - centroid) ** 2).sum(axis=1)
+    closest = member_idx[np.argsort(distances)[:max(SUMMARY_STORIES, MIN_CLUSTER_SIZE)]]
+    max_chars = min(SUMMARY_STORY_MAX_CHARS, int(np.median([len(stories[i]) for i in closest])))
+    return [stories[i][:max_chars] for i in closest]
+
+
+# ─── Main ─────────────────────────────────────────────────────────
+
+def build_clusters(week_id):
+    db = get_db()
+    ensure_indexes()
+
+    print("=" * 60)
+    print(f"  The Cutting Room — Story Clusters ({week_id})")
+    print("=" * 60)
+
+    week_stories = get_week_stories(week_id)
+    print(f"\nFound {len(week_stories)} tracks with a story")
+    if len(week_stories) < MIN_CLUSTER_SIZE:
+        print("Not enough stories to cluster. Exiting.")
+        return
+
+    track_ids = [track_id for track_id, _ in week_stories]
+    stories = [story for _, story in week_stories]
+
+    vectors = embed_stories(stories)
+    k = choose_k(len(stories))
+    labels, centroids = kmeans(vectors, k)
+    print(f"Clustered into k={k}")
+
+    # Summaries of last run's clusters, reused when the same tracks have the
+    # same stories (tracks keep growing during the week)
+    previous = {
+        doc.get("stories_digest"): (doc["_id"], doc["summary"])
+        for doc in db.story_clusters.find({"week_id": week_id}, {"stories_digest": 1, "summary": 1})
+    }
+
+    assignments = []
+    for cluster_index in range(k):
+        member_idx = np.flatnonzero(labels == cluster_index)
+        if len(member_idx) < MIN_CLUSTER_SIZE:
+            continue
+
+        members = [track_ids[i] for i in member_idx]
+        digest = stories_digest(members, [stories[i] for i in member_idx])
+        reused = previous.get(digest)
+        if reused:
+            cluster_id, summary = reused
+            print(f"\n  Cluster {cluster_index}: {len(members)} tracks (unchanged, summary reused)")
+        else:
+            summary = generate_cluster_summary(
+                representative_stories(member_idx, vectors, centroids[cluster_index], stories)
+            )
+            cluster_id = db.story_clusters.insert_one({
+                "week_id": week_id,
+                "summary": summary,
+                "track_ids": members,
+                "stories_digest": digest,
+                "size": len(members),
+                "created_at": datetime.utcnow()
+            }).inserted_id
+            print(f"\n  Cluster {cluster_index}: {len(members)} tracks")
+            print(f"         Summary: {summary[:100]}{'...' if len(summary) > 100 else ''}")
+
+        assignments.append((cluster_id, members))
+
+    # Point tracks at their new clusters, then drop the old cluster docs
+    assigned = []
+    for cluster_id, members in assignments:
+        db.tracks.update_many({"_id": {"$in": members}}, {"$set": {"story_cluster_id": cluster_id}})
+        assigned.extend(members)
+    db.tracks.update_many(
+        {"week_id": week_id, "_id": {"$nin": assigned}, "story_cluster_id": {"$exists": True}},
+        {"$unset": {"story_cluster_id": ""}}
+    )
+    removed = db.story_clusters.delete_many({
+        "week_id": week_id,
+        "_id": {"$nin": [cluster_id for cluster_id, _ in assignments]}
+    })
+
+    print(f"\n{'=' * 60}")
+    print(f"  Clusters stored: {len(assignments)}  (removed {removed.deleted_count} stale)")
+    print(f"  Tracks assigned: {sum(len(m) for _, m in assignments)}/{len(track_ids)}")
+    print(f"{'=' * 60}")
+
+
+if __name__ == "__main__":
+    build_clusters(sys.argv[1] if len(sys.argv) > 1 else get_week_id())
@@ -1,23 +1,14 @@
-import google.genai as genai
-import google.genai.types as types
-from pathlib import Path
-from dotenv import load_dotenv
-import os
+from config import get_client, get_prompt_cache
 
-# Load .env from server directory
-load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env')
+# Returned when the vision response can't be parsed; never worth caching.
+FALLBACK_IMAGE_DESCRIPTION = "An uploaded image."
 
-client = genai.Client(api_key=os.environ.get("GOOGLE_GEMINI_API"))
-
-STORY_PROMPT_TEMPLATE = """
+# Static instructions — sent as the system instruction so they can be cached.
+STORY_INSTRUCTIONS = """
 You are a friendly storyteller helping someone tell the story of their week, one moment at a time.
 Your job is to keep the story going in a way that feels real and personal, like a diary entry written by a good friend.
 
-Here is the story so far:
-{story_so_far}
-
-Here is the new moment they just shared:
-{user_input}
+You will be given the story so far, followed by the new moment they just shared.
 
 What to do:
 1. Look at what they shared:
@@ -29,28 +20,59 @@ What to do:
    - Connect what's happening on the outside to how they might be feeling inside.
 
 Give your answer as JSON like this:
-{{
+{
   "description": "A simple description of what was shared (like 'A photo of a rainy window' or 'A note about feeling lost')",
   "story_segment": "The next part of the story goes here."
-}}
+}
+"""
+
+# story_so_far only grows by appending, so this header + story is a stable,
+# cacheable prefix and the new moment always comes after it.
+STORY_SO_FAR_TEMPLATE = """Here is the story so far:
+{story_so_far}"""
+
+NEW_MOMENT_TEMPLATE = """
+
+Here is the new moment they just shared:
+{user_input}
+"""
+
+# Several independent text notes answered in one call (backfills).
+BATCH_STORY_INSTRUCTIONS = STORY_INSTRUCTIONS + """
+This time you are given several unrelated people's stories at once, each marked with an id.
+Handle each one completely on its own — never carry names, places or feelings from one story into another.
+Answer with a JSON array holding one object per id, in any order:
+[
+  {"id": 0, "description": "...", "story_segment": "..."}
+]
+"""
+
+BATCH_ITEM_TEMPLATE = """=== Story id {id} ===
+{story_so_far}{new_moment}
 """
 
+
+def _generate_story(story_so_far, moment_parts):
+    """Run a story call, reusing cached prefixes."""
+    return get_prompt_cache().generate(
+        get_client(),
+        "story",
+        STORY_INSTRUCTIONS,
+        prefix=STORY_SO_FAR_TEMPLATE.format(
+            story_so_far=story_so_far if story_so_far else "(This is the beginning of the story.)"
+        ),
+        contents=moment_parts,
+        response_mime_type="application/json"
+    )
+
+
 def generate_story_from_text(text_content, story_so_far=""):
     """
     Generate a story segment from text input.
     """
-    prompt = STORY_PROMPT_TEMPLATE.format(
-        story_so_far=story_so_far if story_so_far else "(This is the beginning of the story.)",
-        user_input=f"Text Note: \"{text_content}\""
-    )
-
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt,
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json"
-        )
-    )
+    response = _generate_story(story_so_far, [
+        NEW_MOMENT_TEMPLATE.format(user_input=f"Text Note: \"{text_content}\"")
+    ])
     
     # Simple parsing since we requested JSON
     import json
@@ -64,35 +86,101 @@ def generate_story_from_text(text_content, story_so_far=""):
             "story_segment": text_content
         }
 
-def generate_story_from_image(image_bytes, mime_type, story_so_far=""):
-    """
-    Generate a story segment from an image.
+def generate_stories_from_texts(jobs):
     """
-    prompt = STORY_PROMPT_TEMPLATE.format(
-        story_so_far=story_so_far if story_so_far else "(This is the beginning of the story.)",
-        user_input="(Analyzed from the attached image)"
-    )
+    Generate story segments for several independent text notes in one call.
+
+    Args:
+        jobs: List of (text_content, story_so_far) pairs
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[
-            types.Part.from_bytes(
-                data=image_bytes,
-                mime_type=mime_type,
+    Returns:
+        A list aligned with jobs. Entries the model didn't answer (or
+        answered malformed) are None, so the caller can retry them one by one.
+    """
+    prompt = "\n".join(
+        BATCH_ITEM_TEMPLATE.format(
+            id=i,
+            story_so_far=STORY_SO_FAR_TEMPLATE.format(
+                story_so_far=story_so_far if story_so_far else "(This is the beginning of the story.)"
             ),
-            prompt
-        ],
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json"
+            new_moment=NEW_MOMENT_TEMPLATE.format(user_input=f"Text Note: \"{text_content}\"")
         )
+        for i, (text_content, story_so_far) in enumerate(jobs)
+    )
+
+    response = get_prompt_cache().generate(
+        get_client(),
+        "story-batch",
+        BATCH_STORY_INSTRUCTIONS,
+        contents=[prompt],
+        response_mime_type="application/json"
     )
 
+    import json
+    results = [None] * len(jobs)
+    try:
+        answers = json.loads(response.text)
+    except Exception as e:
+        print(f"JSON parsing failed: {e}. Raw: {response.text}")
+        return results
+
+    for answer in answers if isinstance(answers, list) else []:
+        try:
+            i = int(answer["id"])
+            if 0 <= i < len(jobs) and answer["story_segment"]:
+                results[i] = {
+                    "description": answer.get("description") or "A text note.",
+                    "story_segment": answer["story_segment"]
+                }
+        except (KeyError, TypeError, ValueError):
+            continue
+    return results
+
+
+def generate_story_from_image(image_bytes, mime_type, story_so_far=""):
+    """
+    Generate a story segment from an image.
+    """
+    import google.genai.types as types
+
+    response = _generate_story(story_so_far, [
+        types.Part.from_bytes(
+            data=image_bytes,
+            mime_type=mime_type,
+        ),
+        NEW_MOMENT_TEMPLATE.format(user_input="(Analyzed from the attached image)")
+    ])
+
     import json
     try:
         return json.loads(response.text)
     except Exception as e:
         print(f"JSON parsing failed: {e}. Raw: {response.text}")
         return {
-            "description": "An uploaded image.",
+            "description": FALLBACK_IMAGE_DESCRIPTION,
             "story_segment": "A new moment was captured, but the words escape me."
-        }
\ No newline at end of file
+        }
+
+def generate_story_from_description(description, story_so_far=""):
+    """
+    Generate a story segment for a photo we have already described.
+
+    Used when an upload is a near-duplicate of an earlier image: the stored
+    description stands in for the picture, so this is a text-only call.
+    """
+    response = _generate_story(story_so_far, [
+        NEW_MOMENT_TEMPLATE.format(user_input=f"Photo (already described): \"{description}\"")
+    ])
+
+    import json
+    try:
+        result = json.loads(response.text)
+        story_segment = result["story_segment"]
+    except Exception as e:
+        print(f"JSON parsing failed: {e}. Raw: {response.text}")
+        story_segment = "A new moment was captured, but the words escape me."
+
+    return {
+        "description": description,
+        "story_segment": story_segment
+    }
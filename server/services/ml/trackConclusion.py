@@ -1,12 +1,4 @@
-import google.genai as genai
-from pathlib import Path
-from dotenv import load_dotenv
-import os
-
-# Load .env from server directory
-load_dotenv(Path(__file__).resolve().parent.parent.parent / '.env')
-
-client = genai.Client(api_key=os.environ.get("GOOGLE_GEMINI_API"))
+from config import get_client, get_prompt_cache
 
 
 conclusion_prompt = """
@@ -42,6 +34,21 @@ A few rules:
 - Keep it warm and encouraging
 """
 
+cluster_summary_prompt = """
+You are reading several people's weekly stories that share a common thread.
+Summarize what these weeks have in common, so it can be shared with others who had a similar week.
+
+Write 2-3 sentences (keep it under 60 words) that:
+- Capture the shared moods, moments and themes
+- Only include a theme if it shows up in more than one story
+- Stay general enough that no single person's week can be recognized
+
+A few rules:
+- Don't use technical words like "users", "items", or "database"
+- Don't name or identify anyone, and don't quote anyone's story
+- Write in third person plural ("people this week...")
+"""
+
 
 def generate_conclusion(story):
     """
@@ -53,9 +60,7 @@ def generate_conclusion(story):
     Returns:
         A conclusion string (2-3 sentences)
     """
-    prompt = f"""{conclusion_prompt}
-
----
+    prompt = f"""---
 Weekly story:
 {story}
 
@@ -63,10 +68,7 @@ Weekly story:
 Write the conclusion:
 """
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt
-    )
+    response = get_prompt_cache().generate(get_client(), "conclusion", conclusion_prompt, contents=[prompt])
 
     return response.text.strip()
 
@@ -86,9 +88,7 @@ def generate_community_reflection(story, similar_stories):
         [f"Anonymous story {i+1}:\n{s}" for i, s in enumerate(similar_stories) if s]
     )
 
-    prompt = f"""{community_prompt}
-
----
+    prompt = f"""---
 Your weekly story:
 {story}
 
@@ -99,9 +99,63 @@ Similar stories from the community:
 Write the community reflection:
 """
 
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=prompt
+    response = get_prompt_cache().generate(get_client(), "community", community_prompt, contents=[prompt])
+
+    return response.text.strip()
+
+
+def generate_community_reflection_from_summary(story, cluster_summary):
+    """
+    Generate a community reflection from a precomputed cluster summary.
+
+    Same output as generate_community_reflection, but the prompt carries one
+    short theme summary instead of other people's full stories.
+
+    Args:
+        story: The user's completed weekly story
+        cluster_summary: Theme summary of the user's weekly story cluster
+
+    Returns:
+        A community reflection string (2-3 sentences)
+    """
+    prompt = f"""---
+Your weekly story:
+{story}
+
+What others with a similar week went through:
+{cluster_summary}
+
+---
+Write the community reflection:
+"""
+
+    response = get_prompt_cache().generate(get_client(), "community", community_prompt, contents=[prompt])
+
+    return response.text.strip()
+
+
+def generate_cluster_summary(stories):
+    """
+    Summarize the common themes of a cluster of weekly stories.
+
+    Args:
+        stories: Representative stories from one cluster
+
+    Returns:
+        A short theme summary (2-3 sentences)
+    """
+    stories_text = "\n\n".join(
+        [f"Story {i+1}:\n{s}" for i, s in enumerate(stories) if s]
     )
 
+    prompt = f"""---
+Weekly stories:
+{stories_text}
+
+---
+Write the summary:
+"""
+
+    response = get_prompt_cache().generate(get_client(), "cluster-summary", cluster_summary_prompt, contents=[prompt])
+
     return response.text.strip()
@@ -5,6 +5,7 @@
  * The ML service handles ONLY: 
  * - Story generation from Images
  * - Story generation from Text
+ * - Batched story generation (backfills)
  * - Track Conclusion
  * 
  * All orchestration (item storage, node creation, track management, daily
@@ -22,12 +23,14 @@ const FormData = require('form-data');
  * @param {string} filename
  * @param {string} storySoFar
  * @param {string} mimetype - e.g., 'image/jpeg' or 'image/png'
+ * @param {string} [userId] - uploader; near-duplicate reuse is scoped to their own images
  * @returns {Promise<{description: string, story_segment: string}>}
  */
-const generateStoryFromImage = async (imageBuffer, filename, storySoFar = "", mimetype = "image/jpeg") => {
+const generateStoryFromImage = async (imageBuffer, filename, storySoFar = "", mimetype = "image/jpeg", userId = "") => {
     const form = new FormData();
     form.append('file', imageBuffer, { filename, contentType: mimetype });
     form.append('story_so_far', storySoFar);
+    form.append('user_id', String(userId));
 
     const res = await fetch(`${MODEL_API_URL}/api/ml/story-from-image`, {
         method: 'POST',
@@ -62,17 +65,39 @@ const generateStoryFromText = async (text, storySoFar = "") => {
     return res.json();
 };
 
+/**
+ * Generate story segments for many independent jobs in one request (backfills).
+ * Each job is { text } or { image_url } (or { image_base64, mime_type }), plus story_so_far.
+ * Image jobs should carry the owner's user_id; without it near-duplicate reuse is skipped.
+ * @param {Array<{text?: string, image_url?: string, image_base64?: string, mime_type?: string, story_so_far?: string, user_id?: string}>} jobs
+ * @returns {Promise<{results: Array<{description: string, story_segment: string}|null>, errors: Array<{index: number, error: string}>}>}
+ */
+const generateStoryBatch = async (jobs) => {
+    const res = await fetch(`${MODEL_API_URL}/api/ml/story-batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ jobs })
+    });
+
+    if (!res.ok) {
+        const errorText = await res.text();
+        throw new Error(`ML story-batch error: ${res.status} - ${errorText}`);
+    }
+    return res.json();
+};
+
 /**
  * Generate a track conclusion + community reflection via LLM.
  * @param {string} story - the track's accumulated story
  * @param {string[]} [similarStories=[]] - other users' stories for community reflection
+ * @param {string|null} [clusterSummary=null] - precomputed weekly cluster summary; used instead of similarStories
  * @returns {Promise<{conclusion: string, community_reflection: string}>}
  */
-const generateConclusion = async (story, similarStories = []) => {
+const generateConclusion = async (story, similarStories = [], clusterSummary = null) => {
     const res = await fetch(`${MODEL_API_URL}/api/ml/generate-conclusion`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ story, similar_stories: similarStories })
+        body: JSON.stringify({ story, similar_stories: similarStories, cluster_summary: clusterSummary })
     });
 
     if (!res.ok) {
@@ -85,5 +110,6 @@ const generateConclusion = async (story, similarStories = []) => {
 module.exports = {
     generateStoryFromImage,
     generateStoryFromText,
+    generateStoryBatch,
     generateConclusion
 };